@@ -0,0 +1,220 @@
+"""Benchmarks for projectkit's own operations. Results are printed as JSON so they can be compared across versions.
+
+Examples:
+    python -m projectkit.benchmark startup --repeat 20
+    python -m projectkit.benchmark scale --runs 10000 --data-mb 1024 > bench-0.1.1.json"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import click
+
+from projectkit.db import connect
+
+COMMANDS = ["init", "run", "sweep", "enqueue", "worker", "jobs", "find", "results", "clean", "data"]
+MODULES = ["sqlite3", "click", "git", "hashlib", "multiprocessing"]
+
+def run_process(args, cwd, stdin=None):
+    """Runs the current interpreter with `args` in `cwd`, using this copy of projectkit.
+
+    Returns the wall time in seconds and the exit code."""
+
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join([root, "."] + [p for p in [env.get("PYTHONPATH")] if p])
+
+    with open(os.devnull, "w") as devnull:
+        start = time.time()
+        process = subprocess.Popen([sys.executable] + args, cwd=cwd, env=env, stdin=subprocess.PIPE, stdout=devnull, stderr=devnull)
+        process.communicate(stdin)
+        return time.time() - start, process.returncode
+
+def time_process(args, cwd, repeat):
+    """Returns the best wall time in seconds of `repeat` runs of the current interpreter with `args`."""
+
+    return min(run_process(args, cwd)[0] for _ in range(repeat))
+
+def timed(results, name, args, cwd, stdin=None, **extra):
+    """Runs a projectkit command once and stores its time, exit status and `extra` fields derived from the time."""
+
+    elapsed, code = run_process(["-m", "projectkit.project"] + args, cwd, stdin)
+    results[name] = dict({"seconds": elapsed, "ok": code == 0}, **{k: f(elapsed) for k, f in extra.items()})
+    return elapsed
+
+def report(suite, results, **params):
+    print(json.dumps({
+        "suite": suite,
+        "python": platform.python_version(),
+        "time": time.time(),
+        "params": params,
+        "results": results,
+    }, indent=2, sort_keys=True))
+
+BENCH_MAIN = """
+import json
+
+class Model(object):
+    def __init__(self, epoch):
+        self.epoch = epoch
+
+    def save(self, fout):
+        with open(fout, 'w') as f:
+            f.write(str(self.epoch))
+
+def make_run(data, outdir, args):
+    epochs = int(args.get('epochs', 1000))
+    save_every = int(args.get('save_every', 100))
+
+    def run():
+        for i in range(epochs):
+            loss = 1.0 / (i + 1)
+            yield {'epoch': i, 'stats': json.dumps({'train:loss': loss, 'test:loss': 2 * loss})}, (Model(i) if i % save_every == 0 else None)
+
+    return run()
+"""
+
+BENCH_GEN = """
+def generate(fin, args):
+    with open(fin, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            yield chunk
+"""
+
+def count_files(path):
+    return sum(len(files) for _, _, files in os.walk(path))
+
+def populate(db, datasets, runs, epochs, checkpoints, checkpoint_bytes=1024):
+    """Fills `db` with `datasets` dataset versions and `runs` finished runs of `epochs` epochs each,
+    of which `checkpoints` per run have a checkpoint file of `checkpoint_bytes` bytes, created in the
+    project holding `db` so that clean has real files to delete."""
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(db)))
+    payload = b"\0" * checkpoint_bytes
+    conn = connect(db)
+    save_every = max(1, epochs // max(1, checkpoints))
+    conn.executemany("INSERT INTO data (key, fname, version, hash, code_hash, params) VALUES (?, ?, ?, ?, ?, ?)",
+                     (("ds{}".format(i % 100), "ds{}v{}.data".format(i % 100, i // 100 + 1), i // 100 + 1, "0" * 32, "0" * 40, "{}") for i in range(datasets)))
+    for run in range(runs):
+        cur = conn.execute("INSERT INTO expmeta (key, data_key, data_ver, code_hash, params) VALUES (?, ?, ?, ?, ?)", ("run{}".format(run % 100), "ds0", 1, "0" * 40, "{}"))
+        exp = cur.lastrowid
+        run_str = "run{}_{}".format(run % 100, run // 100)
+        os.makedirs(os.path.join(root, "models", run_str))
+        for i in range(0, epochs, save_every):
+            with open(os.path.join(root, "models", run_str, "{}_{}.pkl".format(run_str, i)), "wb") as f:
+                f.write(payload)
+        conn.executemany("INSERT INTO expres (fname, exp, epoch, result) VALUES (?, ?, ?, ?)",
+                         (("models/{0}/{0}_{1}.pkl".format(run_str, i) if i % save_every == 0 else None, exp, i, json.dumps({"train:loss": 1.0 / (i + 1), "test:loss": 2.0 / (i + 1)})) for i in range(epochs)))
+    conn.commit()
+    conn.close()
+
+@click.group()
+def cli():
+    pass
+
+@cli.command()
+@click.option("--datasets", default=1000, help="Dataset versions in the synthetic database")
+@click.option("--runs", default=1000, help="Finished runs in the synthetic database")
+@click.option("--epochs", default=100, help="Epochs per synthetic run")
+@click.option("--checkpoints", default=10, help="Checkpoints per synthetic run")
+@click.option("--checkpoint-kb", default=1, help="Size in KiB of each synthetic checkpoint file")
+@click.option("--run-epochs", default=10000, help="Epochs of the run whose result ingestion is timed")
+@click.option("--data-mb", default=256, help="Size in MiB of the raw input used to time data gen and data check")
+@click.option("--lookups", default=1000, help="Number of latest() calls to time")
+def scale(datasets, runs, epochs, checkpoints, checkpoint_kb, run_epochs, data_mb, lookups):
+    """Times projectkit's commands on a synthetic project built with init in a temporary directory."""
+
+    from projectkit.db import latest
+    from projectkit import project
+
+    tmp = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    results = {}
+    try:
+        timed(results, "init", ["init"], tmp)
+
+        os.mkdir(os.path.join(tmp, "src", "bench"))
+        os.mkdir(os.path.join(tmp, "data", "bench"))
+        with open(os.path.join(tmp, "src", "bench", "main.py"), "w") as f:
+            f.write(BENCH_MAIN)
+        with open(os.path.join(tmp, "data", "bench", "gen.py"), "w") as f:
+            f.write(BENCH_GEN)
+        with open(os.path.join(tmp, "raw.data"), "wb") as f:
+            for _ in range(data_mb):
+                f.write(os.urandom(1 << 20))
+
+        mb = lambda elapsed: data_mb / elapsed
+        timed(results, "data_gen", ["data", "gen", "bench", "raw.data", "bench_data"], tmp, mb_per_s=mb)
+        timed(results, "data_gen_cached", ["data", "gen", "bench", "raw.data", "bench_data"], tmp)
+        timed(results, "data_check_warm", ["data", "check", "bench_data"], tmp, mb_per_s=mb)
+
+        os.chdir(tmp)
+        conn = connect()
+        conn.execute("DELETE FROM filehash")
+        conn.commit()
+        conn.close()
+        timed(results, "data_check_cold", ["data", "check", "bench_data"], tmp, mb_per_s=mb)
+
+        start = time.time()
+        populate(os.path.join(tmp, "db", "experiments.db"), datasets, runs, epochs, checkpoints, checkpoint_kb * 1024)
+        elapsed = time.time() - start
+        results["populate"] = {"seconds": elapsed, "rows_per_s": (datasets + runs * (epochs + 1)) / elapsed}
+
+        timed(results, "run", ["run", "bench", "bench_run", "bench_data", "--epochs", str(run_epochs)], tmp, rows_per_s=lambda elapsed: run_epochs / elapsed)
+
+        start = time.time()
+        for i in range(lookups):
+            latest("model", "run{}".format(i % 100))
+            latest("data", "ds{}".format(i % 100))
+        results["latest"] = {"calls": 2 * lookups, "us_per_call": 1e6 * (time.time() - start) / (2 * lookups)}
+        timed(results, "find", ["find", "model", "run0"], tmp)
+
+        # run already snapshotted src/bench, so change it to time a snapshot that has to go through git
+        with open(os.path.join("src", "bench", "main.py"), "a") as f:
+            f.write("\n# changed\n")
+        for name in ["save_dir_changed", "save_dir_unchanged"]:
+            start = time.time()
+            project.save_dir(os.path.join("src", "bench"))
+            results[name] = {"seconds": time.time() - start}
+
+        timed(results, "clean_dry_run", ["clean", "model", "--dry-run"], tmp)
+        before = count_files("models")
+        timed(results, "clean", ["clean", "model", "--yes"], tmp)
+        deleted = before - count_files("models")
+        results["clean"].update(files=deleted, files_per_s=deleted / results["clean"]["seconds"])
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+    report("scale", results, datasets=datasets, runs=runs, epochs=epochs, checkpoints=checkpoints, checkpoint_kb=checkpoint_kb, run_epochs=run_epochs, data_mb=data_mb, lookups=lookups)
+
+@cli.command()
+@click.option("--repeat", default=10, help="Runs per measurement; the best one is kept")
+def startup(repeat):
+    """Measures the startup cost of each command and of projectkit's dependencies, in milliseconds over a bare interpreter."""
+
+    tmp = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(tmp, "db"))
+        connect(os.path.join(tmp, "db", "experiments.db")).close()
+
+        baseline = time_process(["-c", "pass"], tmp, repeat)
+        results = {"interpreter": 1000 * baseline, "commands": {}, "modules": {}}
+
+        for command in COMMANDS:
+            results["commands"][command] = 1000 * (time_process(["-m", "projectkit.project", command, "--help"], tmp, repeat) - baseline)
+        results["commands"]["find (lookup)"] = 1000 * (time_process(["-m", "projectkit.project", "find", "model", "missing"], tmp, repeat) - baseline)
+
+        for module in MODULES:
+            results["modules"][module] = 1000 * (time_process(["-c", "import " + module], tmp, repeat) - baseline)
+    finally:
+        shutil.rmtree(tmp)
+
+    report("startup", results, repeat=repeat)
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,111 @@
+"""Memory-mappable array datasets.
+
+A dataset file holds named NumPy arrays behind a small JSON header, each aligned so it can be mapped
+in place. `load` returns read-only memory maps, so concurrent runs on the same dataset share the page
+cache instead of each holding a copy, and keeps recently loaded datasets in an in-process LRU cache.
+
+In a generator's gen.py, either write a dataset from run(fin, fout, args):
+
+    dataset.save(fout, {'train': x_train, 'test': x_test})
+
+or stream it from generate(fin, args), which also hashes it without reading it back:
+
+    return dataset.chunks({'train': x_train, 'test': x_test})
+
+and read it from make_run(data, outdir, args) with `dataset.load(data)`."""
+
+import os
+import json
+import struct
+from collections import OrderedDict
+
+from projectkit.db import shard_paths
+
+MAGIC = b"PKARRAYS\x01"
+ALIGNMENT = 64
+CHUNK_SIZE = 1 << 24
+CACHE_SIZE = 8
+
+_cache = OrderedDict()
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def chunks(arrays):
+    """Yields the bytes of a dataset file holding the dict of NumPy `arrays`, at most CHUNK_SIZE at a time."""
+
+    import numpy as np
+
+    # Unlike ascontiguousarray, asarray keeps 0-d arrays 0-d
+    arrays = [(name, np.asarray(arrays[name], order="C")) for name in sorted(arrays)]
+    header = {}
+    offset = 0
+    for name, array in arrays:
+        if array.dtype.hasobject:
+            raise ValueError("Array \"{}\" has dtype {}, which can't be memory mapped".format(name, array.dtype))
+        header[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps(header, sort_keys=True).encode("utf-8")
+    prefix = MAGIC + struct.pack("<Q", len(header)) + header
+    yield prefix + b"\0" * (_align(len(prefix)) - len(prefix))
+
+    for name, array in arrays:
+        data = array.reshape(-1).view(np.uint8)
+        for start in range(0, len(data), CHUNK_SIZE):
+            yield data[start:start + CHUNK_SIZE].tobytes()
+        yield b"\0" * (_align(array.nbytes) - array.nbytes)
+
+def save(fname, arrays):
+    """Writes the dict of NumPy `arrays` to the dataset file `fname`."""
+
+    with open(fname, "wb") as f:
+        for chunk in chunks(arrays):
+            f.write(chunk)
+
+def _read_header(fname):
+    with open(fname, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a projectkit array dataset".format(fname))
+        size, = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(size).decode("utf-8"))
+    return header, _align(len(MAGIC) + 8 + size)
+
+def load(fname):
+    """Returns a dict of read-only memory-mapped arrays for the dataset file `fname`.
+
+    The last CACHE_SIZE datasets loaded by this process are cached, keyed by the file's identity and
+    modification time, so loading an unchanged dataset again costs nothing."""
+
+    import numpy as np
+
+    st = os.stat(fname)
+    key = (os.path.abspath(fname), st.st_size, st.st_mtime, st.st_ino)
+    if key in _cache:
+        arrays = _cache.pop(key)
+        _cache[key] = arrays
+        return arrays
+
+    header, start = _read_header(fname)
+    arrays = {}
+    for name, info in header.items():
+        shape = tuple(info["shape"])
+        if int(np.prod(shape)) == 0:
+            # mmap can't map empty regions
+            arrays[name] = np.empty(shape, dtype=info["dtype"])
+            arrays[name].flags.writeable = False
+        elif not shape:
+            # memmap can't take an empty shape, so 0-d arrays are mapped as one element
+            arrays[name] = np.memmap(fname, dtype=info["dtype"], mode="r", offset=start + info["offset"], shape=(1,)).reshape(())
+        else:
+            arrays[name] = np.memmap(fname, dtype=info["dtype"], mode="r", offset=start + info["offset"], shape=shape)
+
+    _cache[key] = arrays
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return arrays
+
+def load_shards(fname):
+    """Returns the list of `load` results for each shard of a sharded dataset, or for `fname` itself otherwise."""
+
+    return [load(path) for path in shard_paths(fname)]
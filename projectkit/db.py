@@ -0,0 +1,124 @@
+"""Project database access. Imports nothing beyond sqlite3 and the standard library basics, so that
+looking up runs and datasets stays cheap for scripts and shell pipelines."""
+
+import os
+import sqlite3
+import threading
+import traceback
+
+DB_PATH = "db/experiments.db"
+
+# WAL lets readers and the result writer work concurrently, but needs all connections on one host.
+# Set PROJECTKIT_JOURNAL_MODE=DELETE when workers on several machines share the project directory.
+JOURNAL_MODE = os.environ.get("PROJECTKIT_JOURNAL_MODE", "WAL")
+
+# Each entry upgrades the schema by one version; PRAGMA user_version holds the number of entries applied.
+# Only ever append to this list.
+MIGRATIONS = [
+    [
+        "CREATE TABLE IF NOT EXISTS data (id INTEGER PRIMARY KEY AUTOINCREMENT, fname TEXT NOT NULL, hash TEXT, code_hash TEXT, version INT NOT NULL DEFAULT(1), key TEXT NOT NULL, params TEXT)",
+        "CREATE TABLE IF NOT EXISTS expmeta (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, data_key INT, data_ver INT NOT NULL, code_hash TEXT, params TEXT, FOREIGN KEY (data_key) REFERENCES data (id))",
+        "CREATE TABLE IF NOT EXISTS expres (id INTEGER PRIMARY KEY AUTOINCREMENT, exp INT NOT NULL, fname TEXT, epoch INT NOT NULL, result TEXT NOT NULL, FOREIGN KEY (exp) REFERENCES expmeta (id))",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS gencache (id INTEGER PRIMARY KEY AUTOINCREMENT, gen TEXT NOT NULL, input_hash TEXT NOT NULL, code_hash TEXT, params TEXT NOT NULL, data_id INT NOT NULL, hit INT NOT NULL, created TEXT, FOREIGN KEY (data_id) REFERENCES data (id))",
+        "CREATE TABLE IF NOT EXISTS filehash (path TEXT PRIMARY KEY, size INT NOT NULL, mtime REAL NOT NULL, inode INT NOT NULL, hash TEXT NOT NULL)",
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS data_key_version ON data (key, version)",
+        "CREATE INDEX IF NOT EXISTS expmeta_key_id ON expmeta (key, id)",
+        "CREATE INDEX IF NOT EXISTS expres_exp_id ON expres (exp, id)",
+        "CREATE INDEX IF NOT EXISTS gencache_lookup ON gencache (gen, input_hash, code_hash, params)",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS shards (id INTEGER PRIMARY KEY AUTOINCREMENT, data_id INT NOT NULL, shard INT NOT NULL, fname TEXT NOT NULL, hash TEXT NOT NULL, FOREIGN KEY (data_id) REFERENCES data (id))",
+        "CREATE INDEX IF NOT EXISTS shards_data_shard ON shards (data_id, shard)",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS expperf (id INTEGER PRIMARY KEY AUTOINCREMENT, exp INT NOT NULL, epoch INT, step_time REAL, save_time REAL, db_time REAL, max_rss INT, FOREIGN KEY (exp) REFERENCES expmeta (id))",
+        "CREATE INDEX IF NOT EXISTS expperf_exp_epoch ON expperf (exp, epoch)",
+    ],
+    [
+        "CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, exp TEXT NOT NULL, key TEXT NOT NULL, data_key TEXT NOT NULL, params TEXT NOT NULL, options TEXT NOT NULL, state TEXT NOT NULL DEFAULT('queued'), worker TEXT, heartbeat REAL, attempts INT NOT NULL DEFAULT(0), run TEXT, error TEXT, created REAL, finished REAL)",
+        "CREATE INDEX IF NOT EXISTS jobs_state_id ON jobs (state, id)",
+    ],
+    [
+        "ALTER TABLE expperf ADD COLUMN db_rows_per_s REAL",
+    ],
+]
+
+def migrate(conn):
+    """Upgrades the database behind `conn` to the latest schema version."""
+
+    cur = conn.cursor()
+    cur.execute("PRAGMA user_version")
+    if cur.fetchone()[0] >= len(MIGRATIONS):
+        return
+
+    # Take the write lock before re-reading the version so concurrent processes migrate only once
+    conn.commit()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("PRAGMA user_version")
+        version = cur.fetchone()[0]
+        for i in range(version, len(MIGRATIONS)):
+            for statement in MIGRATIONS[i]:
+                cur.execute(statement)
+            cur.execute("PRAGMA user_version = {}".format(i + 1))
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+
+def connect(db=DB_PATH):
+    """Opens the project database, upgrading its schema if needed."""
+
+    conn = sqlite3.connect(db, timeout=30)
+    migrate(conn)
+    return conn
+
+_connections = {}
+
+def cached_connection(db=DB_PATH):
+    """Returns a connection to `db` that is reused by every call from the same process and thread.
+
+    Reusing the connection also reuses sqlite3's prepared statement cache."""
+
+    key = (os.getpid(), threading.current_thread().ident, os.path.abspath(db))
+    conn = _connections.get(key)
+    if conn is None:
+        conn = connect(db)
+        _connections[key] = conn
+    return conn
+
+def latest(what, which, db=DB_PATH):
+    """Finds the object corresponding to the latest `what`, identified by `which`"""
+    assert what in ["model", "data"]
+
+    try:
+        cur = cached_connection(db).cursor()
+
+        if what == 'data':
+            cur.execute("SELECT fname FROM data WHERE key = ? ORDER BY version DESC LIMIT 1", (which,))
+        elif what == 'model':
+            cur.execute("SELECT fname FROM expres WHERE exp = (SELECT id FROM expmeta WHERE key = ? ORDER BY id DESC LIMIT 1) AND fname IS NOT NULL ORDER BY id DESC LIMIT 1", (which,))
+        fname = cur.fetchone()
+
+        return fname[0] if fname is not None else None
+
+    except Exception as e:
+        print("ERROR: Failed to find latest \"{}\" with key \"{}\"".format(what, which))
+        traceback.print_exc()
+        raise e
+
+def shard_paths(path):
+    """Returns the files making up the dataset at `path`: the shards listed in a `.shards` manifest, or `path` itself."""
+
+    if not path.endswith(".shards"):
+        return [path]
+
+    import json
+
+    with open(path) as f:
+        manifest = json.load(f)
+    return [os.path.join(os.path.dirname(path), shard["fname"]) for shard in manifest["shards"]]
@@ -1,72 +1,779 @@
-import click
 import os
 import sys
-import subprocess
-import hashlib
 import sqlite3
 import json
+import traceback
+from projectkit.db import DB_PATH, JOURNAL_MODE, connect, latest
+
+# Shell pipelines call `find` a lot, so answer it before importing click and the rest of the CLI
+if __name__ == '__main__' and len(sys.argv) == 4 and sys.argv[1] == 'find' and sys.argv[2] in ["data", "model"]:
+    print(latest(sys.argv[2], sys.argv[3]))
+    sys.exit(0)
+
+import click
+import contextlib
 import datetime
 import glob
-import traceback
 import importlib
-import git
+import errno
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 def gather_params(args):
     return {args[i].lstrip('-'): args[i+1] for i in range(0, len(args), 2)}
 
-def save_dir(path, version):
+MANIFEST_NAME = "projectkit-manifest.json"
+
+# Bytecode is rewritten by every import and is not part of the code version
+SNAPSHOT_EXCLUDE = ["__pycache__/", "*.pyc", "*.pyo"]
+SNAPSHOT_IDENTITY = ["user.name=projectkit", "user.email=projectkit@localhost"]
+
+def dir_manifest(path):
+    """Maps every snapshotted file under `path` to its (size, mtime, inode)."""
+
+    manifest = {}
+    for root, dirs, files in os.walk(path):
+        for name in ['.git', '__pycache__']:
+            if name in dirs:
+                dirs.remove(name)
+        for name in files:
+            if name.endswith(('.pyc', '.pyo')):
+                continue
+            fname = os.path.join(root, name)
+            st = os.lstat(fname)
+            manifest[os.path.relpath(fname, path)] = [st.st_size, st.st_mtime, st.st_ino]
+    return manifest
+
+@contextlib.contextmanager
+def snapshot_lock(path):
+    """Holds an exclusive lock on snapshots of `path`, shared with other processes and, over NFS, other hosts."""
+
     try:
-        repo = git.Repo(path)
-    except:
-        repo = git.Repo.init(path, bare=True)
-        repo.git.init()
-    
-    repo.git.add("-A")
+        import fcntl
+    except ImportError:
+        yield
+        return
+
+    path = os.path.abspath(path)
+    with open(os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".lock"), "a") as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.lockf(lock, fcntl.LOCK_UN)
+
+def save_dir(path):
+    """Snapshots the source tree at `path` in its own git repository and returns the git tree hash.
+
+    Git is only invoked if a file was added, removed or touched since the last snapshot."""
+
+    manifest = dir_manifest(path)
+    manifest_fname = os.path.join(path, ".git", MANIFEST_NAME)
     try:
-        repo.git.commit("-a", message='"Update ' + str(version) + '"')
-        repo.git.tag(str(version + 1))
-        return str(version + 1)
-    except:
-        return str(version)
+        with open(manifest_fname) as f:
+            saved = json.load(f)
+        if saved["files"] == manifest:
+            return saved["tree"]
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    import git
+
+    with snapshot_lock(path):
+        try:
+            repo = git.Repo(path)
+        except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError):
+            repo = git.Repo.init(path)
+            with open(os.path.join(repo.git_dir, "info", "exclude"), "a") as f:
+                f.write("\n".join(SNAPSHOT_EXCLUDE) + "\n")
+
+        repo.git.add("-A")
+        tree = repo.git.write_tree()
+        head_tree = repo.head.commit.tree.hexsha if repo.head.is_valid() else None
+        if tree != head_tree:
+            # Snapshots are internal, so they use a fixed identity that works on hosts without a git config
+            repo.git(c=SNAPSHOT_IDENTITY).commit("--allow-empty", message="Update " + tree)
+
+        with open(manifest_fname, "w") as f:
+            json.dump({"tree": tree, "files": manifest}, f)
+    return tree
 
+HASH_BUFSIZE = 1 << 20
 
 def hash_file(fname):
+    import hashlib
+
     md5 = hashlib.md5()
 
+    # Large reads keep the syscall count low, and hashlib releases the GIL on big updates
+    # so several files can be hashed concurrently from threads.
     with open(fname, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(HASH_BUFSIZE), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def lookup_filehash(cur, fname):
+    """Returns the cached hash of `fname` if the file's size, mtime and inode are unchanged, None otherwise."""
+
+    st = os.stat(fname)
+    cur.execute("SELECT hash FROM filehash WHERE path = ? AND size = ? AND mtime = ? AND inode = ?", (os.path.abspath(fname), st.st_size, st.st_mtime, st.st_ino))
+    row = cur.fetchone()
+    return row[0] if row is not None else None
+
+def store_filehash(cur, fname, digest, st=None):
+    """Records `digest` as the hash of `fname`. Pass the stat taken before hashing as `st` when available."""
+
+    if st is None:
+        st = os.stat(fname)
+    cur.execute("INSERT OR REPLACE INTO filehash (path, size, mtime, inode, hash) VALUES (?, ?, ?, ?, ?)", (os.path.abspath(fname), st.st_size, st.st_mtime, st.st_ino, digest))
+
+def cached_hash_file(cur, fname):
+    """Like `hash_file`, but skips reading `fname` if it is unchanged since it was last hashed. The caller commits."""
+
+    digest = lookup_filehash(cur, fname)
+    if digest is None:
+        st = os.stat(fname)
+        digest = hash_file(fname)
+        store_filehash(cur, fname, digest, st)
+    return digest
+
+def write_stream(chunks, fname):
+    """Writes the items of `chunks` to `fname`, hashing them on the way, and returns the file's MD5.
+
+    Bytes are written as is; any other item is written as a pickle, so a file of records can be
+    read back by calling `pickle.load` until EOFError."""
+
+    import hashlib
+    import pickle
+
+    md5 = hashlib.md5()
+    with open(fname, 'wb') as f:
+        for chunk in chunks:
+            if not isinstance(chunk, bytes):
+                chunk = pickle.dumps(chunk, pickle.HIGHEST_PROTOCOL)
+            f.write(chunk)
             md5.update(chunk)
     return md5.hexdigest()
 
-def latest(what, which):
-    """Finds the object corresponding to the latest `what`, identified by `which`"""
-    assert what in ["model", "data"]
+def _gen_shard(task):
+    gen, fin, fout, params = task
+    module = importlib.import_module("data." + gen + ".gen")
+    if hasattr(module, "generate"):
+        digest = write_stream(module.generate(fin, params), fout)
+    else:
+        module.run(fin, fout, params)
+        digest = hash_file(fout)
+    return fout, digest
+
+def generate_shards(cur, data_id, gen, fin, prefix, params, shards, jobs=0):
+    """Runs generator `gen` once per shard in a pool of `jobs` processes and records the shards of dataset `data_id`.
+
+    Each shard run gets `shard` and `shards` added to its params and writes `<prefix>.<shard>.data`.
+    The shard file names and hashes are written to the manifest `<prefix>.shards`, whose hash is returned."""
+
+    import multiprocessing
 
+    tasks = [(gen, fin, "{}.{}.data".format(prefix, i), dict(params, shard=i, shards=shards)) for i in range(shards)]
+    pool = multiprocessing.Pool(min(jobs or multiprocessing.cpu_count(), shards))
     try:
-        conn = sqlite3.connect("db/experiments.db")
-        cur = conn.cursor()
+        results = pool.map(_gen_shard, tasks)
+    finally:
+        pool.close()
+        pool.join()
+
+    manifest = []
+    for i, (fout, digest) in enumerate(results):
+        store_filehash(cur, fout, digest)
+        manifest.append({"fname": os.path.basename(fout), "hash": digest})
+        cur.execute("INSERT INTO shards (data_id, shard, fname, hash) VALUES (?, ?, ?, ?)", (data_id, i, os.path.basename(fout), digest))
+
+    return write_stream([json.dumps({"shards": manifest}, indent=1).encode("utf-8")], prefix + ".shards")
+
+def peak_rss():
+    """Returns the peak resident set size of this process in bytes, or None where it can't be measured."""
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+EXPRES_INSERT = "INSERT INTO expres (fname, exp, epoch, result) VALUES (?, ?, ?, ?)"
+EXPPERF_INSERT = "INSERT INTO expperf (exp, epoch, step_time, save_time, db_time, db_rows_per_s, max_rss) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+class ResultWriter(object):
+    """Inserts `expres` and `expperf` rows from a background thread, committing them in batches.
+
+    A commit happens once `commit_rows` rows are pending, or once the oldest pending
+    row has waited `commit_interval` seconds, whichever comes first. `close` flushes
+    everything that was written before returning.
+
+    `expperf` rows are written after the `expres` rows of their batch are committed, and get the time
+    that flush took per result row and its throughput, or those of the previous flush if their epoch's
+    result row was already written by it."""
+
+    def __init__(self, db, commit_rows=100, commit_interval=5.0):
+        self.db = db
+        self.commit_rows = max(1, commit_rows)
+        self.commit_interval = commit_interval
+        self.rows = 0
+        self.commits = 0
+        self.commit_time = 0.0
+        self.error = None
+        self._last_flush = (None, None)
+
+        self._start = time.time()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, fname, exp, epoch, result):
+        self._put(EXPRES_INSERT, (fname, exp, epoch, result))
+
+    def write_perf(self, exp, epoch, step_time, save_time, max_rss):
+        self._put(EXPPERF_INSERT, (exp, epoch, step_time, save_time, max_rss))
+
+    def _put(self, statement, row):
+        if self.error is not None:
+            raise self.error
+        self._queue.put((statement, row))
+
+    def close(self):
+        """Flushes pending rows and stops the writer thread. Raises the writer's error, if any."""
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def summary(self):
+        elapsed = max(time.time() - self._start, 1e-9)
+        latency = 1000.0 * self.commit_time / self.commits if self.commits else 0.0
+        return "Wrote {} rows in {} commits ({:.1f} rows/s, {:.2f} ms average commit latency)".format(
+            self.rows, self.commits, self.rows / elapsed, latency)
+
+    def _commit(self, conn, statement, rows):
+        start = time.time()
+        conn.executemany(statement, rows)
+        conn.commit()
+        elapsed = time.time() - start
+        self.commit_time += elapsed
+        self.commits += 1
+        self.rows += len(rows)
+        return elapsed
+
+    def _flush(self, conn, pending):
+        results = [row for s, row in pending if s == EXPRES_INSERT]
+        perf = [row for s, row in pending if s == EXPPERF_INSERT]
+
+        previous = self._last_flush
+        flushed = set()
+        if results:
+            elapsed = max(self._commit(conn, EXPRES_INSERT, results), 1e-9)
+            self._last_flush = (elapsed / len(results), len(results) / elapsed)
+            flushed = set((exp, epoch) for fname, exp, epoch, result in results)
+
+        if perf:
+            rows = []
+            for exp, epoch, step_time, save_time, max_rss in perf:
+                db_time, rate = self._last_flush if (exp, epoch) in flushed else previous
+                rows.append((exp, epoch, step_time, save_time, db_time, rate, max_rss))
+            self._commit(conn, EXPPERF_INSERT, rows)
+
+    def _loop(self):
+        conn = sqlite3.connect(self.db, timeout=30)
+        conn.execute("PRAGMA journal_mode={}".format(JOURNAL_MODE))
+        pending = []
+        deadline = None
+        done = False
 
-        if what == 'data':
-            cur.execute("SELECT fname, version FROM data WHERE key = ? ORDER BY version DESC LIMIT 1", (which,))
-            fname = cur.fetchone()
-        elif what == 'model':
-            cur.execute('SELECT id FROM expmeta WHERE key = ? ORDER BY id DESC LIMIT 1', (which,))
-            expid = cur.fetchone()
-            if expid is not None:
-                expid = expid[0]
+        try:
+            while not done:
+                timeout = None if deadline is None else max(0.0, deadline - time.time())
+                try:
+                    row = self._queue.get(timeout=timeout)
+                    if row is None:
+                        done = True
+                    else:
+                        if not pending:
+                            deadline = time.time() + self.commit_interval
+                        pending.append(row)
+                except queue.Empty:
+                    pass
+
+                if pending and (done or len(pending) >= self.commit_rows or time.time() >= deadline):
+                    self._flush(conn, pending)
+                    pending = []
+                    deadline = None
+        except Exception as e:
+            self.error = e
+        finally:
+            conn.close()
+
+def lookup_gencache(cur, gen, input_hash, code_hash, params):
+    """Finds a dataset previously generated by `gen` from the same input, code and canonical params.
+
+    Returns (id, key, fname, hash, version) of the dataset, or None if there is none or its file is gone."""
+
+    cur.execute("SELECT d.id, d.key, d.fname, d.hash, d.version FROM gencache g JOIN data d ON d.id = g.data_id WHERE g.gen = ? AND g.input_hash = ? AND g.code_hash = ? AND g.params = ? AND g.hit = 0 ORDER BY g.id DESC LIMIT 1", (gen, input_hash, code_hash, params))
+    row = cur.fetchone()
+    if row is None or not os.path.exists(os.path.join("data", row[2])):
+        return None
+    return row
+
+class CheckpointSaver(object):
+    """Saves models from a background thread, handing each result row to `writer` once its checkpoint is on disk.
+
+    At most `max_pending` saves wait in the queue; `save` blocks while it is full. A model must not be
+    modified by the run after it was yielded. `close` waits for every queued save. After a failed save,
+    no more checkpoints are saved but the result rows of the failed and queued saves are still written,
+    without a checkpoint file."""
+
+    def __init__(self, writer, max_pending=1):
+        self.writer = writer
+        self.saves = 0
+        self.save_time = 0.0
+        self.error = None
+
+        self._queue = queue.Queue(max(1, max_pending))
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, model, fname, exp, epoch, result):
+        if self.error is not None:
+            raise self.error
+        self._queue.put((model, fname, exp, epoch, result))
+
+    def close(self):
+        """Waits for pending saves and stops the saver thread. Raises the first save error, if any."""
+        self._queue.put(None)
+        self._thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def summary(self):
+        average = self.save_time / self.saves if self.saves else 0.0
+        return "Saved {} checkpoints in the background ({:.2f} s average save time)".format(self.saves, average)
+
+    def _loop(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            model, fname, exp, epoch, result = job
+            if self.error is None:
+                try:
+                    start = time.time()
+                    model.save(fname)
+                    self.save_time += time.time() - start
+                    self.saves += 1
+                except Exception as e:
+                    self.error = e
+            if self.error is not None:
+                # Keep draining so that `save` and `close` never block on a dead saver, but keep the results
+                fname = None
+            try:
+                self.writer.write(fname, exp, epoch, result)
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+
+def format_bytes(size):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if size < 1024:
+            return "{:.1f} {}".format(size, unit)
+        size /= 1024.0
+    return "{:.1f} TiB".format(size)
+
+def remove_files(paths, dry_run=False, jobs=0):
+    """Deletes `paths` from a thread pool, or only measures them if `dry_run`.
+
+    Returns the paths that are gone (including those that were already missing), the number of
+    bytes reclaimed and the paths that couldn't be deleted."""
+
+    from multiprocessing.pool import ThreadPool
+    import multiprocessing
+
+    def remove(path):
+        try:
+            size = os.stat(path).st_size
+            if not dry_run:
+                os.remove(path)
+            return path, size, True
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return path, 0, True
+            print("WARNING: Could not delete {}: {}".format(path, e))
+            return path, 0, False
+
+    gone, failed, reclaimed = [], [], 0
+    if not paths:
+        return gone, reclaimed, failed
+
+    pool = ThreadPool(max(1, min(jobs or 4 * multiprocessing.cpu_count(), len(paths))))
+    try:
+        for path, size, ok in pool.imap_unordered(remove, paths, 64):
+            if ok:
+                gone.append(path)
+                reclaimed += size
             else:
-                expid = -1
-            cur.execute("SELECT fname FROM expres WHERE exp = ? AND fname IS NOT NULL ORDER BY id DESC LIMIT 1", (expid,))
-            fname = cur.fetchone()
-        else:
-            print("ERROR: don't know what a \"{}\" is".format(what))
+                failed.append(path)
+    finally:
+        pool.close()
+        pool.join()
+    return gone, reclaimed, failed
+
+def checkpoint_candidates(cur, keep_last=1, keep_best=0, metric=None, maximize=False, keep_referenced=True, keys=None, exps=None):
+    """Returns (expres id, fname) of every checkpoint the retention policy doesn't keep, in one query.
+
+    Per run, the `keep_last` most recent checkpoints and the `keep_best` best ones by `metric` are kept.
+    The latest checkpoint of the latest run of each key, which `latest` returns, is always kept, and so
+    is any checkpoint named in a run's params if `keep_referenced`. Runs are selected as in `results`."""
+
+    from projectkit.results import run_filter, metric_path
+
+    condition, params = run_filter(keys, exps)
+    path = metric_path(metric) if metric is not None else None
+    cur.execute("""
+        WITH ckpt AS (
+            SELECT r.id, r.fname,
+                   ROW_NUMBER() OVER (PARTITION BY r.exp ORDER BY r.id DESC) AS recent,
+                   ROW_NUMBER() OVER (PARTITION BY r.exp ORDER BY json_extract(r.result, ?) IS NULL, json_extract(r.result, ?) {}) AS best,
+                   r.exp = (SELECT MAX(id) FROM expmeta WHERE key = m.key) AS latest_run
+            FROM expres r JOIN expmeta m ON m.id = r.exp
+            WHERE r.fname IS NOT NULL AND {})
+        SELECT id, fname FROM ckpt
+        WHERE recent > ? AND best > ? AND NOT (latest_run AND recent = 1)
+            AND (? = 0 OR fname NOT IN (SELECT j.value FROM expmeta, json_each(expmeta.params) j WHERE j.type = 'text'))
+        """.format("DESC" if maximize else "ASC", condition), [path, path] + params + [keep_last, keep_best, int(keep_referenced)])
+    return cur.fetchall()
+
+def collect_checkpoints(conn, candidates, jobs=0):
+    """Deletes the checkpoint files of `candidates` from `checkpoint_candidates` in parallel, then clears
+    their fname in one transaction. The result rows themselves are kept. Returns (files, bytes) reclaimed."""
+
+    gone, reclaimed, failed = remove_files([fname for _, fname in candidates], jobs=jobs)
+    gone = set(gone)
+    with conn:
+        conn.executemany("UPDATE expres SET fname = NULL WHERE id = ?", [(i,) for i, fname in candidates if fname in gone])
+    return len(gone), reclaimed
+
+def data_candidates(cur, keep_last=1, keep_referenced=True, keys=None):
+    """Returns the ids of the dataset versions the retention policy doesn't keep, and the files only they use.
+
+    Per key, the `keep_last` most recent versions are kept, as is any version a run used if `keep_referenced`.
+    Files shared with a kept version through a generation cache alias are not returned."""
+
+    condition = "d.key IN ({})".format(", ".join("?" * len(keys))) if keys else "1"
+    cur.execute("DROP TABLE IF EXISTS temp.gc_data")
+    cur.execute("CREATE TEMP TABLE gc_data (id INTEGER PRIMARY KEY)")
+    cur.execute("""
+        INSERT INTO gc_data
+        SELECT id FROM (
+            SELECT d.id, d.key, d.version, ROW_NUMBER() OVER (PARTITION BY d.key ORDER BY d.version DESC, d.id DESC) AS recent
+            FROM data d WHERE {}) v
+        WHERE recent > ? AND (? = 0 OR NOT EXISTS (SELECT 1 FROM expmeta m WHERE m.data_key = v.key AND m.data_ver = v.version))
+        """.format(condition), list(keys or []) + [keep_last, int(keep_referenced)])
+    cur.execute("SELECT id FROM gc_data")
+    ids = [row[0] for row in cur.fetchall()]
+    cur.execute("""
+        SELECT fname FROM data WHERE id IN gc_data UNION SELECT fname FROM shards WHERE data_id IN gc_data
+        EXCEPT SELECT fname FROM data WHERE id NOT IN gc_data EXCEPT SELECT fname FROM shards WHERE data_id NOT IN gc_data
+        """)
+    paths = [os.path.join("data", row[0]) for row in cur.fetchall()]
+    return ids, paths
+
+def collect_data(conn, ids, paths, jobs=0):
+    """Deletes the dataset files `paths` in parallel, then the versions `ids` and their shard and cache rows
+    in one transaction. Returns (files, bytes) reclaimed.
+
+    The generation cache entry of a deleted version whose file is kept by an alias is moved to the newest
+    such alias, so that `data gen` still finds it."""
+
+    gone, reclaimed, failed = remove_files(paths, jobs=jobs)
+    if failed:
+        raise IOError("Could not delete {} dataset files, leaving the database unchanged".format(len(failed)))
+    deleted = set(ids)
+    with conn:
+        for data_id in ids:
+            cur = conn.execute("SELECT id FROM data WHERE fname = (SELECT fname FROM data WHERE id = ?) ORDER BY id DESC", (data_id,))
+            aliases = [row[0] for row in cur.fetchall() if row[0] not in deleted]
+            if aliases:
+                conn.execute("UPDATE gencache SET data_id = ? WHERE data_id = ? AND hit = 0", (aliases[0], data_id))
+        for table, column in [("gencache", "data_id"), ("shards", "data_id"), ("data", "id")]:
+            conn.executemany("DELETE FROM {} WHERE {} = ?".format(table, column), [(i,) for i in ids])
+    return len(gone), reclaimed
+
+def allocate_run(key):
+    """Reserves the next free run name for `key` by exclusively creating its log file.
+
+    Returns the run name and the opened stdout log. Safe to call from concurrent processes."""
+
+    idx = len(glob.glob("models/logs/{}_*.out".format(key)))
+    while True:
+        run_str = "{}_{}".format(key, idx)
+        try:
+            fd = os.open("models/logs/{}.out".format(run_str), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            idx += 1
+            continue
+        return run_str, os.fdopen(fd, "w")
+
+def run_experiment(exp, key, data_key, main_args, code_hash=None, commit_rows=100, commit_interval=5.0, async_saves=0, perf=True, profile=False,
+                   retain_last=None, retain_best=0, retain_metric=None, retain_max=False):
+    """Runs experiment `exp` as a new run of `key` on the latest `data_key` dataset, returning the run name.
+
+    Output is redirected to the run's log files for the duration of the run. If `code_hash` is None,
+    `src/<exp>` is snapshotted first. If `async_saves` is positive, checkpoints are saved by a
+    `CheckpointSaver` with that many pending saves.
+
+    With `perf`, each epoch's generator time, checkpoint save time (time spent waiting on the saver
+    when saving asynchronously) and peak RSS are recorded in `expperf`, followed by a row with a NULL
+    epoch holding the run's totals. Each row also gets the database time per row and throughput of
+    the `ResultWriter` flush that wrote its epoch's result; the totals row has those of the whole run.
+    With `profile`, the run is profiled and the stats are saved as `models/<run>/<run>.prof`.
+
+    If `retain_last` or `retain_best` is set, the run's checkpoints are garbage collected as it goes,
+    using the policy of `checkpoint_candidates` on the checkpoints committed so far."""
+
+    run_str, out = allocate_run(key)
+    err = open("models/logs/{}.err".format(run_str), "w")
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = out, err
+
+    try:
+        conn = connect()
+        cur = conn.cursor()
+
+        cur.execute("SELECT fname, version FROM data WHERE key = ? ORDER BY version DESC LIMIT 1", (data_key,))
+        data_fname, data_ver = cur.fetchone()
+
+        if code_hash is None:
+            code_hash = save_dir(os.path.join('src', exp))
+
+        cur.execute('INSERT INTO expmeta (key, data_key, data_ver, code_hash, params) VALUES (?, ?, ?, ?, ?)', (key,  data_key, data_ver, code_hash, json.dumps(main_args)))
+        conn.commit()
+
+        cur.execute("SELECT last_insert_rowid()")
+        expid = cur.fetchone()[0]
+
+        dirname = os.path.join("models", run_str)
+        savename = os.path.join(dirname, run_str)
 
-        return fname[0] if fname is not None else None
+        try:
+            os.mkdir(dirname)
+        except:
+            pass
+ 
+        profiler = None
+        if profile:
+            import cProfile
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        writer = ResultWriter(DB_PATH, commit_rows, commit_interval)
+        saver = CheckpointSaver(writer, async_saves) if async_saves > 0 else None
+        step_total = save_total = 0.0
+        retention = None
+        if retain_last is not None or retain_best:
+            retention = dict(keep_last=retain_last if retain_last is not None else 0, keep_best=retain_best,
+                             metric=retain_metric, maximize=retain_max, exps=[expid])
+        collected = reclaimed = 0
+        try:
+            module = importlib.import_module("src." + exp + ".main")
+            run_gen = iter(module.make_run(os.path.join("data", data_fname), os.path.join("models", key), main_args))
+
+            while True:
+                start = time.time()
+                try:
+                    stats, model = next(run_gen)
+                except StopIteration:
+                    break
+                step_time = time.time() - start
+
+                save_fname = None
+                save_time = None
+                if model is not None:
+                    save_fname = savename + "_" + str(stats['epoch']) + ".pkl"
+                    start = time.time()
+                    if saver is not None:
+                        saver.save(model, save_fname, expid, stats["epoch"], stats["stats"])
+                    else:
+                        model.save(save_fname)
+                    save_time = time.time() - start
+                    save_total += save_time
+
+                    if retention is not None:
+                        files, size = collect_checkpoints(conn, checkpoint_candidates(cur, **retention))
+                        collected += files
+                        reclaimed += size
+
+                if saver is None or model is None:
+                    writer.write(save_fname, expid, stats["epoch"], stats["stats"])
+                if perf:
+                    writer.write_perf(expid, stats["epoch"], step_time, save_time, peak_rss())
+                step_total += step_time
+        finally:
+            try:
+                if saver is not None:
+                    saver.close()
+                    print(saver.summary())
+            finally:
+                writer.close()
+                print(writer.summary())
+
+                if profiler is not None:
+                    profiler.disable()
+                    profiler.dump_stats(savename + ".prof")
+                    print("Profile saved to {}.prof".format(savename))
+
+        if retention is not None:
+            files, size = collect_checkpoints(conn, checkpoint_candidates(cur, **retention))
+            print("Retention removed {} checkpoints ({})".format(collected + files, format_bytes(reclaimed + size)))
+
+        if perf:
+            cur.execute(EXPPERF_INSERT, (expid, None, step_total, save_total, writer.commit_time, writer.rows / max(writer.commit_time, 1e-9), peak_rss()))
+            conn.commit()
 
+        conn.close()
+        return run_str
     except Exception as e:
-        print("ERROR: Failed to find latest \"{}\" with key \"{}\"".format(what, which))
+        print("ERROR: Failed to run project")
         traceback.print_exc()
         raise e
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        out.close()
+        err.close()
+
+def expand_grid(args):
+    """Expands trailing arguments of the form --key v1,v2,... into the list of all parameter combinations."""
+
+    import itertools
+
+    params = gather_params(args)
+    keys = sorted(params.keys())
+    values = [params[k].split(",") for k in keys]
+    return [dict(zip(keys, combo)) for combo in itertools.product(*values)]
+
+def _sweep_worker(job):
+    exp, key, data_key, params, code_hash, options = job
+    try:
+        return params, run_experiment(exp, key, data_key, params, code_hash, **options), None
+    except Exception:
+        return params, None, traceback.format_exc()
+
+def claim_job(conn, worker, timeout=300, max_attempts=3):
+    """Atomically claims the oldest queued job for `worker`, returning (id, exp, key, data_key, params, options) or None.
+
+    Running jobs whose worker hasn't sent a heartbeat for `timeout` seconds are first put back in the
+    queue, or failed once they were attempted `max_attempts` times. Heartbeats use each host's clock,
+    so worker clocks should be synchronized well within `timeout`."""
+
+    now = time.time()
+    cur = conn.cursor()
+    conn.commit()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        cur.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, error = 'Worker ' || worker || ' stopped sending heartbeats', worker = NULL WHERE state = 'running' AND heartbeat < ?", (max_attempts, now - timeout))
+        cur.execute("SELECT id, exp, key, data_key, params, options FROM jobs WHERE state = 'queued' ORDER BY id LIMIT 1")
+        job = cur.fetchone()
+        if job is not None:
+            cur.execute("UPDATE jobs SET state = 'running', worker = ?, heartbeat = ?, attempts = attempts + 1 WHERE id = ?", (worker, now, job[0]))
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    return job
+
+def _job_process(pipe, job):
+    pipe.send(_sweep_worker(job))
+    pipe.close()
+
+def execute_job(conn, worker, job, heartbeat=30, max_attempts=3):
+    """Runs a job claimed by `worker` in a child process, sending a heartbeat every `heartbeat` seconds,
+    and records its outcome. Returns the job's final state. Interrupting puts the job back in the queue,
+    as does the child dying without reporting (e.g. killed for lack of memory) until `max_attempts`."""
+
+    import multiprocessing
+
+    job_id, exp, key, data_key, params, options = job
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=_job_process, args=(sender, (exp, key, data_key, json.loads(params), None, json.loads(options))))
+    outcome = None
+    try:
+        process.start()
+        sender.close()
+        while outcome is None:
+            if receiver.poll(heartbeat):
+                try:
+                    outcome = receiver.recv()
+                except EOFError:
+                    break
+            elif not process.is_alive():
+                if not receiver.poll(0):
+                    break
+            else:
+                cur = conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker = ? AND state = 'running'", (time.time(), job_id, worker))
+                conn.commit()
+                if cur.rowcount == 0:
+                    print("WARNING: Job {} was taken away from this worker, which was presumed dead".format(job_id))
+        process.join()
+    except BaseException:
+        if process.is_alive():
+            process.terminate()
+            process.join()
+        conn.rollback()
+        conn.execute("UPDATE jobs SET state = 'queued', worker = NULL WHERE id = ? AND worker = ?", (job_id, worker))
+        conn.commit()
+        raise
+    finally:
+        receiver.close()
+
+    if outcome is None:
+        conn.execute("UPDATE jobs SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, worker = NULL, error = ? WHERE id = ? AND worker = ?",
+                     (max_attempts, "Run process exited with code {} without reporting".format(process.exitcode), job_id, worker))
+        conn.commit()
+        cur = conn.execute("SELECT state FROM jobs WHERE id = ?", (job_id,))
+        return cur.fetchone()[0]
+
+    params, run_str, error = outcome
+    state = 'done' if error is None else 'failed'
+    conn.execute("UPDATE jobs SET state = ?, run = ?, error = ?, finished = ? WHERE id = ? AND worker = ?", (state, run_str, error, time.time(), job_id, worker))
+    conn.commit()
+    return state
+
+def run_options(f):
+    """Adds the options shared by `run` and `sweep`, which are passed on to `run_experiment`."""
+
+    f = click.option("--commit-rows", default=100, help="Number of result rows to buffer before committing")(f)
+    f = click.option("--commit-interval", default=5.0, help="Maximum number of seconds a result row stays uncommitted")(f)
+    f = click.option("--async-saves", default=0, help="Save checkpoints in the background with up to this many saves pending (0 saves synchronously)")(f)
+    f = click.option("--perf/--no-perf", default=True, help="Record per-epoch timings and memory use in the expperf table")(f)
+    f = click.option("--profile", is_flag=True, help="Run under cProfile and save the stats in the run's directory")(f)
+    f = click.option("--retain-last", type=int, default=None, help="Delete checkpoints during the run, keeping this many recent ones (see clean --keep-last)")(f)
+    f = click.option("--retain-best", default=0, help="Delete checkpoints during the run, keeping this many best ones by --retain-metric (see clean --keep-best)")(f)
+    f = click.option("--retain-metric", default=None, help="Metric for --retain-best")(f)
+    f = click.option("--retain-max", is_flag=True, help="For --retain-best, higher --retain-metric is better")(f)
+    return f
+
+def check_run_options(options):
+    """Rejects `run_options` combinations that `run_experiment` can't honour."""
+
+    if options["retain_best"] and options["retain_metric"] is None:
+        raise click.UsageError("--retain-best requires --retain-metric")
 
 @click.group()
 def cli():
@@ -86,9 +793,9 @@ def init():
         os.mkdir('src/example')
         os.mkdir('data/example')
 
-        open('__init__.py', 'wa').close()
-        open('src/__init__.py', 'wa').close()
-        open('data/__init__.py', 'wa').close()
+        open('__init__.py', 'a').close()
+        open('src/__init__.py', 'a').close()
+        open('data/__init__.py', 'a').close()
 
         src_main = open('src/example/main.py', 'w')
         src_main.write("""
@@ -146,14 +853,7 @@ def run(fin, fout, args):
 """)
         data_gen.close()
 
-        conn = sqlite3.connect("db/experiments.db")
-        cur = conn.cursor()
-
-        cur.execute("CREATE TABLE data (id INTEGER PRIMARY KEY AUTOINCREMENT, fname TEXT NOT NULL, hash TEXT, code_hash TEXT, version INT NOT NULL DEFAULT(1), key TEXT NOT NULL, params TEXT)")
-        cur.execute("CREATE TABLE expmeta (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, data_key INT, data_ver INT NOT NULL, code_hash TEXT, params TEXT, FOREIGN KEY (data_key) REFERENCES data (id))")
-        cur.execute("CREATE TABLE expres (id INTEGER PRIMARY KEY AUTOINCREMENT, exp INT NOT NULL, fname TEXT, epoch INT NOT NULL, result TEXT NOT NULL, FOREIGN KEY (exp) REFERENCES expmeta (id))")
-        conn.commit()
-
+        conn = connect()
         conn.close()
         
     except Exception as e:
@@ -169,65 +869,148 @@ def run(fin, fout, args):
 @click.argument("exp") # experiment
 @click.argument("key") # exp name
 @click.argument("data_key") # data name
+@run_options
 @click.pass_context
-def run(ctx, exp, key, data_key):
+def run(ctx, exp, key, data_key, **options):
     """Run project. Trailing arguments of the form --key value are passed to the called module."""
 
-    idx = len(glob.glob("models/logs/{}_*.out".format(key)))
-    run_str = "{}_{}".format(key, idx)
-    sys.stdout = open("models/logs/{}.out".format(run_str), "w")
-    sys.stderr = open("models/logs/{}.err".format(run_str), "w")
-
-    try:
-        main_args = gather_params(ctx.args)
+    check_run_options(options)
+    run_experiment(exp, key, data_key, gather_params(ctx.args), **options)
 
-        conn = sqlite3.connect("db/experiments.db")
-        cur = conn.cursor()
+@cli.command(
+    context_settings=dict(
+        ignore_unknown_options=True,
+        allow_extra_args=True)
+)
+@click.argument("exp") # experiment
+@click.argument("key") # exp name
+@click.argument("data_key") # data name
+@click.option("--workers", default=0, help="Number of runs to execute concurrently (default: one per CPU)")
+@click.option("--configs", type=click.Path(exists=True), default=None, help="JSON file holding a list of parameter sets")
+@run_options
+@click.pass_context
+def sweep(ctx, exp, key, data_key, workers, configs, **options):
+    """Parameter sweep. Trailing arguments of the form --key v1,v2,... are expanded into a grid,
+    combined with every parameter set in --configs, and each resulting set is run in its own process."""
 
-        cur.execute("SELECT fname, version FROM data WHERE key = ? ORDER BY version DESC LIMIT 1", (data_key,))
-        data_fname, data_ver = cur.fetchone()
+    check_run_options(options)
+    try:
+        base = [{}]
+        if configs is not None:
+            with open(configs) as f:
+                base = json.load(f)
 
-        cur.execute("SELECT code_hash FROM expmeta WHERE key = ? ORDER BY code_hash DESC LIMIT 1", (key,))
-        ver = cur.fetchone()
-        if ver is None:
-            ver = 1
-        else:
-            ver = ver[0]
+        param_sets = [dict(b, **g) for b in base for g in expand_grid(ctx.args)]
 
-        hashes = save_dir(os.path.join('src', key), ver)
+        # Snapshot once up front so that concurrent runs don't race on the source repository
+        code_hash = save_dir(os.path.join('src', exp))
+    except Exception as e:
+        print("ERROR: Failed to prepare the sweep")
+        traceback.print_exc()
+        raise e
 
-        cur.execute('INSERT INTO expmeta (key, data_key, data_ver, code_hash, params) VALUES (?, ?, ?, ?, ?)', (key,  data_key, data_ver, hashes, json.dumps(main_args)))
-        conn.commit()
+    import multiprocessing
 
-        cur.execute("SELECT last_insert_rowid()")
-        expid = cur.fetchone()[0]
+    workers = workers or multiprocessing.cpu_count()
+    print("Running {} configurations on {} workers".format(len(param_sets), workers))
+    jobs = [(exp, key, data_key, p, code_hash, options) for p in param_sets]
 
-        dirname = os.path.join("models", run_str)
-        savename = os.path.join(dirname, run_str)
+    failed = 0
+    pool = multiprocessing.Pool(workers, maxtasksperchild=1)
+    try:
+        for params, run_str, error in pool.imap_unordered(_sweep_worker, jobs):
+            if error is None:
+                print("{}: done {}".format(run_str, json.dumps(params)))
+            else:
+                failed += 1
+                print("ERROR: run with parameters {} failed:\n{}".format(json.dumps(params), error))
+    finally:
+        pool.close()
+        pool.join()
 
-        try:
-            os.mkdir(dirname)
-        except:
-            pass
- 
-        module = importlib.import_module("src." + exp + ".main")
-        run_gen = module.make_run(os.path.join("data", data_fname), os.path.join("models", key), main_args)
+    if failed:
+        print("{} of {} runs failed".format(failed, len(jobs)))
+        sys.exit(1)
 
-        for stats, model in run_gen:
-            save_fname = None
-            if model is not None:
-                save_fname = savename + "_" + str(stats['epoch']) + ".pkl"
-                model.save(save_fname)
+@cli.command(
+    context_settings=dict(
+        ignore_unknown_options=True,
+        allow_extra_args=True)
+)
+@click.argument("exp") # experiment
+@click.argument("key") # exp name
+@click.argument("data_key") # data name
+@click.option("--grid", is_flag=True, help="Expand trailing arguments of the form --key v1,v2,... into one job per combination, as in sweep")
+@run_options
+@click.pass_context
+def enqueue(ctx, exp, key, data_key, grid, **options):
+    """Queues runs for `worker` processes. Trailing arguments of the form --key value are passed to the called module."""
 
-            cur.execute("INSERT INTO expres (fname, exp, epoch, result) VALUES (?, ?, ?, ?)", (save_fname, expid, stats["epoch"], stats["stats"]))
-            conn.commit()
+    check_run_options(options)
+    try:
+        param_sets = expand_grid(ctx.args) if grid else [gather_params(ctx.args)]
 
+        conn = connect()
+        now = time.time()
+        with conn:
+            conn.executemany("INSERT INTO jobs (exp, key, data_key, params, options, created) VALUES (?, ?, ?, ?, ?, ?)",
+                             [(exp, key, data_key, json.dumps(params), json.dumps(options), now) for params in param_sets])
         conn.close()
+        print("Queued {} jobs".format(len(param_sets)))
     except Exception as e:
-        print("ERROR: Failed to run project")
+        print("ERROR: Failed to queue runs")
         traceback.print_exc()
         raise e
 
+@cli.command()
+@click.option("--poll", default=5.0, help="Seconds to wait before checking an empty queue again")
+@click.option("--heartbeat", default=30.0, help="Seconds between heartbeats while running a job")
+@click.option("--timeout", default=300.0, help="Seconds without heartbeat after which another worker's job is requeued")
+@click.option("--max-attempts", default=3, help="Number of times a job is started before it is failed")
+@click.option("--exit-when-empty", is_flag=True, help="Stop once the queue is empty instead of waiting for jobs")
+def worker(poll, heartbeat, timeout, max_attempts, exit_when_empty):
+    """Runs queued jobs one at a time until interrupted. Start one per core and per machine sharing the project."""
+
+    import socket
+
+    name = "{}:{}".format(socket.gethostname(), os.getpid())
+    conn = connect()
+    conn.execute("PRAGMA journal_mode={}".format(JOURNAL_MODE))
+    print("Worker {} started".format(name))
+
+    try:
+        while True:
+            job = claim_job(conn, name, timeout, max_attempts)
+            if job is None:
+                if exit_when_empty:
+                    break
+                time.sleep(poll)
+                continue
+
+            print("Running job {} ({} {} {} {})".format(job[0], job[1], job[2], job[3], job[4]))
+            print("Job {} {}".format(job[0], execute_job(conn, name, job, heartbeat, max_attempts)))
+    except KeyboardInterrupt:
+        print("Worker {} interrupted".format(name))
+    finally:
+        conn.close()
+
+@cli.command()
+@click.option("--state", type=click.Choice(["queued", "running", "done", "failed"]), default=None, help="Only list jobs in this state")
+def jobs(state):
+    """Lists queued jobs and their state."""
+
+    conn = connect()
+    cur = conn.cursor()
+    if state is None:
+        cur.execute("SELECT id, state, attempts, worker, exp, key, data_key, params, run FROM jobs ORDER BY id")
+    else:
+        cur.execute("SELECT id, state, attempts, worker, exp, key, data_key, params, run FROM jobs WHERE state = ? ORDER BY id", (state,))
+    for row in cur.fetchall():
+        print("\t".join(str(col) for col in row))
+    cur.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state ORDER BY state")
+    print(", ".join("{} {}".format(count, s) for s, count in cur.fetchall()))
+    conn.close()
+
 @cli.command()
 @click.argument("what", type=click.Choice(["data", "model"]))
 @click.argument("which")
@@ -236,47 +1019,95 @@ def find(what, which):
 
     print(latest(what, which))
 
+@cli.command()
+@click.argument("verb", type=click.Choice(["best", "export"]))
+@click.argument("target") # metric for best, output file for export
+@click.argument("keys", nargs=-1) # run names
+@click.option("--exp", "exps", type=int, multiple=True, help="Also select the run with this expmeta id")
+@click.option("--max", "maximize", is_flag=True, help="Best means highest rather than lowest")
+def results(verb, target, keys, exps, maximize):
+    """Result queries. `best METRIC KEYS...` prints the best epoch of each run, `export FILE KEYS...` writes
+    the runs' per-epoch metrics as NumPy arrays to a .npz file. All runs are used if no key or --exp is given."""
+
+    from projectkit import results as res
+
+    try:
+        if verb == "best":
+            for key, exp, epoch, value, fname in res.best_epochs(target, keys, exps, maximize):
+                print("{}\t{}\t{}\t{}\t{}".format(key, exp, epoch, value, fname))
+        elif verb == "export":
+            count = res.export_npz(target, keys, exps)
+            print("Exported {} rows to {}".format(count, target))
+    except Exception as e:
+        print("ERROR: Failed to {} results (keys: {}, runs: {})".format(verb, keys, exps))
+        traceback.print_exc()
+        raise e
+
 @cli.command()
 @click.argument("what", type=click.Choice(["data", "model"]))
-def clean(what):
-    """Cleanup function."""
+@click.argument("keys", nargs=-1)
+@click.option("--keep-last", default=1, help="Checkpoints to keep per run, or versions to keep per dataset")
+@click.option("--keep-best", default=0, help="Also keep this many checkpoints per run with the best --metric")
+@click.option("--metric", default=None, help="Metric for --keep-best, as in the run's stats (e.g. test:loss)")
+@click.option("--max", "maximize", is_flag=True, help="For --keep-best, higher --metric is better")
+@click.option("--keep-referenced/--no-keep-referenced", default=True, help="Keep checkpoints named in a run's params and datasets used by a run")
+@click.option("--dry-run", is_flag=True, help="Only report what would be deleted")
+@click.option("--yes", "-y", is_flag=True, help="Don't ask for confirmation")
+@click.option("--verbose", "-v", is_flag=True, help="List the files to delete")
+@click.option("--jobs", default=0, help="Number of files to delete concurrently (default: four per CPU)")
+def clean(what, keys, keep_last, keep_best, metric, maximize, keep_referenced, dry_run, yes, verbose, jobs):
+    """Cleanup function. Deletes the checkpoints or dataset versions of the given keys (all if none) that the
+    retention policy doesn't keep. Deleted checkpoints keep their result rows; deleted datasets lose theirs."""
+
+    if keep_best and metric is None:
+        raise click.UsageError("--keep-best requires --metric")
 
     try:
-        conn = sqlite3.connect("db/experiments.db")
+        conn = connect()
         cur = conn.cursor()
 
-        it = 'data' if what == 'data' else 'expres'
-        cur.execute("SELECT DISTINCT key FROM {}".format(it))
-        keys = cur.fetchall()
-        keep = {}
-        delete = []
-
-        for k in keys:
-            cur.execute("SELECT fname FROM {} WHERE key = ? AND fname IS NOT NULL ORDER BY {} DESC LIMIT 1".format(it, 'version' if what == 'data' else 'id'), (k,))
-            keep[k] = cur.fetchone()[0]
-            cur.execute("SELECT fname FROM {} WHERE key = ? AND fname <> ? AND fname IS NOT NULL".format(it), (k, keep[-1]))
-            delete.extend(cur.fetchall())
-        
-        print("WARNING: The following files will be deleted:")
-        for f in delete:
-            print("\t{}".format(f))
-        do_it = input("Proceed [y/N]? ")
-        if do_it.trim().lower() not in ["y", "ye", "yes"]:
+        if what == 'model':
+            candidates = checkpoint_candidates(cur, keep_last, keep_best, metric, maximize, keep_referenced, keys)
+            paths = [fname for _, fname in candidates]
+            ids = []
+        else:
+            ids, paths = data_candidates(cur, keep_last, keep_referenced, keys)
+
+        if verbose:
+            for path in paths:
+                print("\t{}".format(path))
+
+        if dry_run:
+            gone, reclaimed, failed = remove_files(paths, dry_run=True, jobs=jobs)
+            if what == 'data':
+                print("Would delete {} dataset versions".format(len(ids)))
+            print("Would delete {} files, reclaiming {}".format(len(gone), format_bytes(reclaimed)))
+            return
+
+        # Dataset versions may have no files of their own left to delete when they alias kept files
+        if not paths and not ids:
+            print("Nothing to delete")
+            return
+        if what == 'model':
+            warning = "WARNING: {} files will be deleted. Proceed?".format(len(paths))
+        else:
+            warning = "WARNING: {} dataset versions ({} files) will be deleted. Proceed?".format(len(ids), len(paths))
+        if not yes and not click.confirm(warning):
             print("Operation cancelled, quitting")
             sys.exit(2)
 
-        for f in delete:
-            print("Deleting {}...".format(f))
-            os.remove(f)
-        for k, f in keep.iteritems():
-            cur.execute("DROP * FROM {} WHERE fname <> ? AND key = ? AND fname IS NOT NULL".format(it), (k, f))
-        conn.commit()
+        if what == 'model':
+            files, reclaimed = collect_checkpoints(conn, candidates, jobs)
+        else:
+            files, reclaimed = collect_data(conn, ids, paths, jobs)
+            print("Deleted {} dataset versions".format(len(ids)))
+        print("Deleted {} files, reclaiming {}".format(files, format_bytes(reclaimed)))
 
         conn.close()
-            
+
     except Exception as e:
-        print("ERROR: Failed to {} the data (parameters: {})".format(verb, args)) 
-        print("Verify that gen.py script exists and that the database was initialized (project init)")
+        print("ERROR: Failed to clean {} (keys: {})".format(what, keys))
+        print("Verify that the database was initialized (project init)")
         traceback.print_exc()
         raise e
 
@@ -286,21 +1117,31 @@ def clean(what):
         allow_extra_args=True)
 )
 
-@click.argument("verb", type=click.Choice(["check", "gen"]))
+@click.argument("verb", type=click.Choice(["check", "gen", "cache"]))
 @click.argument("args", nargs=-1)
-def data(verb, args):
+@click.option("--force", is_flag=True, help="Regenerate even if an identical dataset already exists")
+@click.option("--all", "check_all", is_flag=True, help="Check the latest version of every dataset")
+@click.option("--jobs", default=0, help="Number of files to hash or shards to generate concurrently (default: one per CPU)")
+@click.option("--shards", default=1, help="Generate the dataset as this many shards, in parallel")
+def data(verb, args, force, check_all, jobs, shards):
     """Data manipulation functions."""
 
+    if verb == "check" and not args and not check_all:
+        raise click.UsageError("data check requires a dataset name or --all")
+
     try:
-        conn = sqlite3.connect("db/experiments.db")
+        conn = connect()
         cur = conn.cursor()
 
         if verb == "gen":
             # args[0] is the generator, args[1] is the raw dataset, args[2] is the dataset name/keyword
+            # gen.py either defines run(fin, fout, args), which writes fout, or generate(fin, args),
+            # which yields the output as byte chunks or picklable records. With --shards, each shard is
+            # generated by its own process, with its index and the shard count in args
 
             module = importlib.import_module("data." + args[0] + ".gen")
 
-            cur.execute("SELECT version FROM data WHERE key = ? ORDER BY version DESC LIMIT 1", (args[2],))
+            cur.execute("SELECT version, fname, id FROM data WHERE key = ? ORDER BY version DESC LIMIT 1", (args[2],))
             prev_ver = cur.fetchone()
 
             if prev_ver is None:
@@ -308,68 +1149,125 @@ def data(verb, args):
             else:
                 version = prev_ver[0] + 1
 
-            vsuffix = "v{}.data".format(version)
-            fname = args[2] + vsuffix
-            short_fname = args[2].rsplit('/', 1)[-1] + vsuffix
-
-            cur.execute("SELECT code_hash FROM data WHERE key = ? ORDER BY code_hash DESC LIMIT 1", (args[2],))
-            ver = cur.fetchone()
-            if ver is None:
-                ver = 1
-            else:
-                ver = ver[0]
-
-            hashes = save_dir(os.path.join('data', args[0]), ver)
+            hashes = save_dir(os.path.join('data', args[0]))
 
             params = gather_params(args[3:])
-            cur.execute("INSERT INTO data (key, fname, version, hash, code_hash, params) VALUES (?, ?, ?, ?, ?, ?)", (args[2], short_fname, version, "", hashes, json.dumps(params)))
-            conn.commit()
-            module.run(args[1], os.path.join("data", fname), params)
-
-            filehash = hash_file(os.path.join("data", fname))
-            cur.execute("UPDATE data SET hash = ? WHERE fname = ?", (filehash, fname))
-            conn.commit()
+            canonical_params = json.dumps(dict(params, shards=shards) if shards > 1 else params, sort_keys=True)
+            input_hash = cached_hash_file(cur, args[1]) if os.path.isfile(args[1]) else None
+
+            cached = None
+            if input_hash is not None:
+                cached = lookup_gencache(cur, args[0], input_hash, hashes, canonical_params)
+
+            if cached is not None and not force:
+                data_id, cached_key, cached_fname, cached_hash, cached_ver = cached
+                # Only the newest version of a key is used by runs, so an older match gets a new version aliasing it
+                if prev_ver is not None and prev_ver[1] == cached_fname:
+                    data_id = prev_ver[2]
+                    print("Cache hit: {} version {} ({}) is up to date".format(args[2], prev_ver[0], cached_fname))
+                else:
+                    cur.execute("INSERT INTO data (key, fname, version, hash, code_hash, params) VALUES (?, ?, ?, ?, ?, ?)", (args[2], cached_fname, version, cached_hash, hashes, json.dumps(params)))
+                    alias_id = cur.lastrowid
+                    cur.execute("INSERT INTO shards (data_id, shard, fname, hash) SELECT ?, shard, fname, hash FROM shards WHERE data_id = ?", (alias_id, data_id))
+                    data_id = alias_id
+                    print("Cache hit: {} version {} aliases {} version {} ({})".format(args[2], version, cached_key, cached_ver, cached_fname))
+                cur.execute("INSERT INTO gencache (gen, input_hash, code_hash, params, data_id, hit, created) VALUES (?, ?, ?, ?, ?, 1, ?)", (args[0], input_hash, hashes, canonical_params, data_id, datetime.datetime.now().isoformat()))
+                conn.commit()
+            else:
+                vsuffix = "v{}.{}".format(version, "shards" if shards > 1 else "data")
+                fname = args[2] + vsuffix
+                short_fname = args[2].rsplit('/', 1)[-1] + vsuffix
+
+                cur.execute("INSERT INTO data (key, fname, version, hash, code_hash, params) VALUES (?, ?, ?, ?, ?, ?)", (args[2], short_fname, version, "", hashes, json.dumps(params)))
+                data_id = cur.lastrowid
+                conn.commit()
+                path = os.path.join("data", fname)
+                if shards > 1:
+                    filehash = generate_shards(cur, data_id, args[0], args[1], os.path.join("data", args[2] + "v{}".format(version)), params, shards, jobs)
+                    store_filehash(cur, path, filehash)
+                elif hasattr(module, "generate"):
+                    # Streaming generators yield the output, which is hashed as it is written
+                    filehash = write_stream(module.generate(args[1], params), path)
+                    store_filehash(cur, path, filehash)
+                else:
+                    module.run(args[1], path, params)
+                    filehash = cached_hash_file(cur, path)
+                cur.execute("UPDATE data SET hash = ? WHERE id = ?", (filehash, data_id))
+                if input_hash is not None:
+                    cur.execute("INSERT INTO gencache (gen, input_hash, code_hash, params, data_id, hit, created) VALUES (?, ?, ?, ?, ?, 0, ?)", (args[0], input_hash, hashes, canonical_params, data_id, datetime.datetime.now().isoformat()))
+                conn.commit()
+
+        elif verb == "cache":
+            # Lists data generation cache hits and misses, optionally restricted to generator args[0]
+            query = "SELECT g.created, g.hit, g.gen, d.key, d.version, d.fname, g.params FROM gencache g LEFT JOIN data d ON d.id = g.data_id"
+            if args:
+                cur.execute(query + " WHERE g.gen = ? ORDER BY g.id", (args[0],))
+            else:
+                cur.execute(query + " ORDER BY g.id")
+            hits = 0
+            rows = cur.fetchall()
+            for created, hit, gen, key, ver, fname, params in rows:
+                hits += hit
+                print("{}\t{}\t{}\t{} v{}\t{}\t{}".format(created, "hit" if hit else "miss", gen, key, ver, fname, params))
+            print("{} hits, {} misses".format(hits, len(rows) - hits))
 
         elif verb == "check":
-            # args[0] is data to check
-            cur.execute("SELECT fname FROM data WHERE key = ?", (args[0],))
-            fname = cur.fetchone()[0]
-            filehash = hash_file(os.path.join("data", fname))
-
-            cur.execute("SELECT hash FROM data WHERE key = ? ORDER BY version DESC LIMIT 1", (args[0],))
-            dbhash = cur.fetchone()[0]
-            if dbhash != filehash:
-                print("WARNING: Latest experiment data does not match current dataset:\n\tCurrent dataset: {}\n\tLatest recorded dataset: {}".format(filehash, dbhash))
+            # args[0] is data to check, or --all to check the latest version of every dataset
+            if check_all:
+                cur.execute("SELECT id, key, fname, hash FROM data d WHERE version = (SELECT MAX(version) FROM data WHERE key = d.key) ORDER BY key")
             else:
-                print("Current dataset matches latest data")
-
-        else:
-            cur.execute("SELECT DISTINCT key FROM data")
-            keys = cur.fetchall()
-            keep = {}
-            delete = []
-
-            for k in keys:
-                cur.execute("SELECT fname FROM data WHERE key = ? ORDER BY version DESC LIMIT 1", (k,))
-                keep[k] = cur.fetchone()[0]
-                cur.execute("SELECT fname FROM data WHERE key = ? AND fname <> ?", (k, keep[-1]))
-                delete.extend(cur.fetchall())
-            
-            print("WARNING: The following files will be deleted:")
-            for f in delete:
-                print("\t{}".format(f))
-            do_it = input("Proceed [y/N]? ")
-            if do_it.trim().lower() not in ["y", "ye", "yes"]:
-                print("Operation cancelled, quitting")
-                sys.exit(2)
-
-            for f in delete:
-                print("Deleting {}...".format(f))
-                os.remove(f)
-            for k, f in keep.iteritems():
-                cur.execute("DROP * FROM data WHERE fname <> ? AND key = ?", (k, f))
+                cur.execute("SELECT id, key, fname, hash FROM data WHERE key = ? ORDER BY version DESC LIMIT 1", (args[0],))
+
+            rows = cur.fetchall()
+            if not rows and not check_all:
+                print("ERROR: No dataset named {}".format(args[0]))
+                conn.close()
+                sys.exit(1)
+
+            # Sharded datasets are checked through their manifest and each of their shards
+            datasets = []
+            for data_id, key, fname, dbhash in rows:
+                datasets.append((key, fname, dbhash))
+                cur.execute("SELECT shard, fname, hash FROM shards WHERE data_id = ? ORDER BY shard", (data_id,))
+                datasets.extend(("{} (shard {})".format(key, shard), shard_fname, shard_hash) for shard, shard_fname, shard_hash in cur.fetchall())
+
+            current = {}
+            misses = []
+            for key, fname, dbhash in datasets:
+                path = os.path.join("data", fname)
+                if not os.path.isfile(path):
+                    current[path] = None
+                    continue
+                current[path] = lookup_filehash(cur, path)
+                if current[path] is None and path not in misses:
+                    misses.append(path)
+
+            def hash_miss(path):
+                st = os.stat(path)
+                return path, st, hash_file(path)
+
+            from multiprocessing.pool import ThreadPool
+            import multiprocessing
+
+            pool = ThreadPool(max(1, min(jobs or multiprocessing.cpu_count(), len(misses))))
+            try:
+                for path, st, digest in pool.imap_unordered(hash_miss, misses):
+                    store_filehash(cur, path, digest, st)
+                    current[path] = digest
+            finally:
+                pool.close()
+                pool.join()
             conn.commit()
 
+            for key, fname, dbhash in datasets:
+                filehash = current[os.path.join("data", fname)]
+                if filehash is None:
+                    print("WARNING: Latest data file for {} ({}) is missing".format(key, fname))
+                elif dbhash != filehash:
+                    print("WARNING: Latest experiment data for {} does not match current dataset:\n\tCurrent dataset: {}\n\tLatest recorded dataset: {}".format(key, filehash, dbhash))
+                else:
+                    print("Current dataset {} matches latest data".format(key))
+
         conn.close()
             
     except Exception as e:
@@ -0,0 +1,99 @@
+"""Bulk access to the per-epoch results stored as JSON in `expres.result`."""
+
+import json
+
+from projectkit.db import DB_PATH, connect
+
+METRIC_PREFIX = "metric:"
+
+def run_filter(keys, exps):
+    """Returns the SQL condition on expres row `r` and its parameters selecting runs by key or expmeta id."""
+
+    conditions = []
+    params = []
+    if keys:
+        conditions.append("r.exp IN (SELECT id FROM expmeta WHERE key IN ({}))".format(", ".join("?" * len(keys))))
+        params.extend(keys)
+    if exps:
+        conditions.append("r.exp IN ({})".format(", ".join("?" * len(exps))))
+        params.extend(exps)
+    if not conditions:
+        return "1", params
+    return "(" + " OR ".join(conditions) + ")", params
+
+def metric_path(metric):
+    """Returns the json_extract path of a top-level metric name, which may contain ':' as in 'test:loss'."""
+
+    return '$."{}"'.format(metric.replace('"', '\\"'))
+
+def iter_results(keys=None, exps=None, db=DB_PATH):
+    """Yields (key, exp, epoch, result dict) for every result row of the selected runs, ordered by run and epoch.
+
+    Runs are selected by expmeta key and/or id; all runs are selected if neither is given."""
+
+    conn = connect(db)
+    try:
+        condition, params = run_filter(keys, exps)
+        cur = conn.execute("SELECT m.key, r.exp, r.epoch, r.result FROM expres r JOIN expmeta m ON m.id = r.exp WHERE {} ORDER BY r.exp, r.epoch, r.id".format(condition), params)
+        for key, exp, epoch, result in cur:
+            yield key, exp, epoch, json.loads(result)
+    finally:
+        conn.close()
+
+def columnar(rows):
+    """Turns rows from `iter_results` into a dict of aligned NumPy arrays: 'key', 'exp', 'epoch' and one
+    float array per top-level metric, with NaN where a row lacks the metric or its value is not a number.
+
+    Metric arrays are named with METRIC_PREFIX (e.g. 'metric:test:loss'), so that metrics can't clash
+    with the run columns."""
+
+    import numpy as np
+
+    keys, exps, epochs = [], [], []
+    metrics = {}
+    for i, (key, exp, epoch, result) in enumerate(rows):
+        keys.append(key)
+        exps.append(exp)
+        epochs.append(epoch)
+        for name, value in result.items():
+            if name not in metrics:
+                metrics[name] = [float("nan")] * i
+            try:
+                metrics[name].append(float(value))
+            except (TypeError, ValueError):
+                metrics[name].append(float("nan"))
+        for name, column in metrics.items():
+            if len(column) <= i:
+                column.append(float("nan"))
+
+    columns = {
+        "key": np.array(keys, dtype=str),
+        "exp": np.array(exps, dtype=np.int64),
+        "epoch": np.array(epochs, dtype=np.int64),
+    }
+    for name, column in metrics.items():
+        columns[METRIC_PREFIX + name] = np.array(column, dtype=np.float64)
+    return columns
+
+def export_npz(fname, keys=None, exps=None, db=DB_PATH):
+    """Writes the columnar results of the selected runs to a compressed .npz file and returns the number of rows."""
+
+    import numpy as np
+
+    columns = columnar(iter_results(keys, exps, db))
+    np.savez_compressed(fname, **columns)
+    return len(columns["exp"])
+
+def best_epochs(metric, keys=None, exps=None, maximize=False, db=DB_PATH):
+    """Returns (key, exp, epoch, value, fname) of the best epoch of each selected run by `metric`, computed in SQL.
+
+    Rows lacking the metric are ignored. `maximize` picks the highest value instead of the lowest."""
+
+    conn = connect(db)
+    try:
+        condition, params = run_filter(keys, exps)
+        # SQLite takes the bare columns of a MIN/MAX aggregate from the row holding the extreme value
+        cur = conn.execute("SELECT m.key, r.exp, r.epoch, {}(json_extract(r.result, ?)) AS value, r.fname FROM expres r JOIN expmeta m ON m.id = r.exp WHERE {} AND json_extract(r.result, ?) IS NOT NULL GROUP BY r.exp ORDER BY r.exp".format("MAX" if maximize else "MIN", condition), [metric_path(metric)] + params + [metric_path(metric)])
+        return cur.fetchall()
+    finally:
+        conn.close()